@@ -1,118 +1,750 @@
 import os
+import sys
+import fcntl
+import shutil
+import asyncio
+import atexit
+import argparse
 import subprocess
 import logging
-from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+import json
+import hashlib
+import queue
+import time
+from contextlib import aclosing, nullcontext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from supabase import create_client, Client
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('database_backup.log'),
-        logging.StreamHandler()
-    ]
-)
+
+# Configure logging; records are handed to a listener thread so file and
+# console writes stay off the dump/upload path
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler('database_backup.log'),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-required_env_vars = {
-    "DB_CONTAINER_NAME": os.getenv("DB_CONTAINER_NAME"),
-    "DB_NAME": os.getenv("DB_NAME"),
-    "DB_USER": os.getenv("DB_USER"),
-    "SUPABASE_URL": os.getenv("SUPABASE_URL"),
-    "SUPABASE_KEY": os.getenv("SUPABASE_KEY"),
-    "SUPABASE_BUCKET": os.getenv("SUPABASE_BUCKET"),
-    "BACKUP_DIR": os.getenv("BACKUP_DIR", "backups"),
-    "DB_PASSWORD": os.getenv("DB_PASSWORD")
-}
+required_env_vars = (
+    "DB_NAME",
+    "DB_USER",
+    "SUPABASE_URL",
+    "SUPABASE_S3_ACCESS_KEY_ID",
+    "SUPABASE_S3_SECRET_ACCESS_KEY",
+    "SUPABASE_S3_REGION",
+    "SUPABASE_BUCKET",
+    "DB_PASSWORD"
+)
 
 
-missing_vars = [var for var, value in required_env_vars.items() if value is None]
+missing_vars = [var for var in required_env_vars if var not in os.environ]
 if missing_vars:
     raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
-DB_CONTAINER_NAME = required_env_vars["DB_CONTAINER_NAME"]
-DB_NAME = required_env_vars["DB_NAME"]
-DB_USER = required_env_vars["DB_USER"]
-SUPABASE_URL = required_env_vars["SUPABASE_URL"]
-SUPABASE_KEY = required_env_vars["SUPABASE_KEY"]
-SUPABASE_BUCKET = required_env_vars["SUPABASE_BUCKET"]
-BACKUP_DIR = required_env_vars["BACKUP_DIR"]
-DB_PASSWORD = required_env_vars["DB_PASSWORD"]
+DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DB_NAME = os.environ["DB_NAME"]
+DB_USER = os.environ["DB_USER"]
+SUPABASE_URL = os.environ["SUPABASE_URL"]
+SUPABASE_S3_ACCESS_KEY_ID = os.environ["SUPABASE_S3_ACCESS_KEY_ID"]
+SUPABASE_S3_SECRET_ACCESS_KEY = os.environ["SUPABASE_S3_SECRET_ACCESS_KEY"]
+SUPABASE_S3_REGION = os.environ["SUPABASE_S3_REGION"]
+SUPABASE_BUCKET = os.environ["SUPABASE_BUCKET"]
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+DB_PASSWORD = os.environ["DB_PASSWORD"]
+# Comma-separated table patterns whose rows are skipped; their definitions are still dumped
+DB_EXCLUDE_TABLE_DATA = [
+    pattern.strip() for pattern in os.environ.get("DB_EXCLUDE_TABLE_DATA", "").split(",") if pattern.strip()
+]
 
 
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# pg_dump reads the password from its environment rather than the command line
+PG_ENV = {**os.environ, "PGPASSWORD": DB_PASSWORD}
+
+# Table change counters as of the last full dump, for differential backups
+STATS_FILE = os.path.join(BACKUP_DIR, ".last_stats.json")
+
+# Held by the running backup so overlapping cron runs don't dump twice
+LOCK_FILE = os.path.join(BACKUP_DIR, ".lock")
+
+# SHA-256 of the most recently uploaded streamed dump, in sha256sum format
+LATEST_DIGEST_KEY = "latest.sha256"
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """Create the Supabase Storage S3 client once and reuse it for every request."""
+    # Supabase Storage only exposes multipart uploads through its S3-compatible endpoint
+    return boto3.client(
+        "s3",
+        endpoint_url=f"{SUPABASE_URL}/storage/v1/s3",
+        region_name=SUPABASE_S3_REGION,
+        aws_access_key_id=SUPABASE_S3_ACCESS_KEY_ID,
+        aws_secret_access_key=SUPABASE_S3_SECRET_ACCESS_KEY,
+        config=Config(
+            s3={"addressing_style": "path"},
+            # Enough keep-alive connections for 8 files uploading 8 parts each,
+            # so concurrent parts reuse sockets instead of redoing TLS handshakes
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            read_timeout=60,
+            retries={"max_attempts": 3, "mode": "standard"}
+        )
+    )
+
+transfer_config = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    use_threads=True,
+    max_concurrency=8
+)
+
+class UnchangedBackup(Exception):
+    """Raised into an upload to abort it when the dump matches the latest backup."""
+
+    def __init__(self, backup_name):
+        super().__init__(backup_name)
+        self.backup_name = backup_name
+
+class ChunkReader:
+    """File-like reader over a queue of chunks, ended by None or an exception."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.eof = False
 
-def backup_database():
-    """Dump the database into a SQL file."""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = os.path.join(BACKUP_DIR, f"db_backup_{timestamp}.sql")
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+def pg_cmd(program, *options):
+    """Build a pg_dump or psql command line for the configured database."""
+    return [
+        program,
+        "-h", DB_HOST,
+        "-p", DB_PORT,
+        "-U", DB_USER,
+        *options,
+        DB_NAME
+    ]
+
+def filter_options(tables):
+    """Build pg_dump's table selection options for a full or differential dump."""
+    options = [option for table in tables or () for option in ("-t", table)]
+    options += [f"--exclude-table-data={pattern}" for pattern in DB_EXCLUDE_TABLE_DATA]
+    return options
+
+async def log_stderr(stream):
+    """Forward a subprocess's stderr to the log line by line."""
+    while line := await stream.readline():
+        logger.warning(line.decode(errors="replace").rstrip())
+
+async def dump_database(compress="9", tables=None):
+    """Run pg_dump and yield the archive in 1 MiB chunks as it is produced."""
+    cmd = pg_cmd("pg_dump", "-Fc", "-Z", compress, *filter_options(tables))
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=PG_ENV,
+        limit=1 << 20
+    )
+    stderr = asyncio.create_task(log_stderr(proc.stderr))
+    try:
+        while True:
+            try:
+                chunk = await proc.stdout.readexactly(1 << 20)
+            except asyncio.IncompleteReadError as e:
+                chunk = e.partial
+            if not chunk:
+                break
+            yield chunk
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    finally:
+        await stderr
+        await proc.wait()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def mask_archive_date(header):
+    """Zero the creation time in a custom-format archive header.
+
+    The header is the only part of an archive that differs between dumps
+    of unchanged data, so it is masked before hashing.
+    """
+    if not header.startswith(b"PGDMP") or len(header) < 12:
+        return header
+
+    version = (header[5], header[6])
+    int_size = header[8]
+    # Archive 1.15 (pg_dump 16) replaced the integer compression level with a single byte
+    start = 12 if version >= (1, 15) else 12 + int_size
+    end = start + 7 * (1 + int_size)
+    return header[:start] + bytes(end - start) + header[end:]
+
+async def backup_database(executor, dump_name, keep_local=False, compress="9", tables=None):
+    """Dump the database into a streaming upload running on 'executor'.
+
+    Returns as soon as pg_dump has finished, with a future for the name of
+    the uploaded backup, or None if the dump failed. If the dump hashes the
+    same as the latest backup, the upload is aborted before it completes, so
+    no duplicate object is stored, and the future gives the latest backup's
+    name instead; most of its parts will already have been sent by then.
+    """
+    file_name = f"{dump_name}.dump"
+    backup_file = os.path.join(BACKUP_DIR, file_name)
+    digest = hashlib.sha256()
+
+    # Bounded so a slow upload applies backpressure to pg_dump instead of buffering the dump
+    chunks = queue.Queue(maxsize=4)
+
+    def upload_and_record():
+        try:
+            uploaded = upload_stream_to_supabase(ChunkReader(chunks), file_name)
+        except UnchangedBackup as e:
+            return e.backup_name
+        if not uploaded:
+            return None
+        # The reader only sees the end of the stream after the last chunk was hashed
+        put_latest_digest(digest.hexdigest(), file_name)
+        return dump_name
+
+    upload = executor.submit(upload_and_record)
+
+    def feed(item):
+        while not upload.done():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def abort(error):
+        # Pending chunks are worthless now, and dropping them lets the error
+        # be queued without waiting on the upload. Failing the read makes
+        # boto3 abort the multipart upload rather than complete it
+        while True:
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                break
+        chunks.put_nowait(error)
+        if keep_local and os.path.isfile(backup_file):
+            os.remove(backup_file)
 
     try:
-        cmd = [
-            "docker", "exec",
-            "-e", f"PGPASSWORD={DB_PASSWORD}",
-            DB_CONTAINER_NAME,
-            "pg_dump",
-            "-U", DB_USER,
-            "-h", "postgres",
-            "-p", "5432",
-            DB_NAME
-        ]
-        
         logger.info(f"Starting database backup")
-        with open(backup_file, "w") as output_file:
-            subprocess.run(
-                cmd,
-                stdout=output_file,
-                check=True
-            )
-        
-        logger.info(f"Database backup successful: {backup_file}")
-        return backup_file
+        with open(backup_file, "wb", buffering=4 * 1024 * 1024) if keep_local else nullcontext() as local_file:
+            # Closing the dump on any error kills pg_dump straight away
+            async with aclosing(dump_database(compress, tables)) as dump:
+                header_seen = False
+                async for chunk in dump:
+                    digest.update(chunk if header_seen else mask_archive_date(chunk))
+                    header_seen = True
+                    if local_file is not None:
+                        local_file.write(chunk)
+                    if not await asyncio.to_thread(feed, chunk):
+                        raise RuntimeError("upload stopped before the dump finished")
+
+        logger.info(f"Database dump finished: {file_name}")
+        latest_digest, latest_file_name = await asyncio.to_thread(get_latest_digest)
+        if digest.hexdigest() == latest_digest:
+            # The --keep-local copy stays, so local cleanup always has a fresh backup to keep
+            logger.info(f"Dump is identical to {latest_file_name}, aborting upload of {file_name}")
+            await asyncio.to_thread(feed, UnchangedBackup(latest_file_name.removesuffix(".dump")))
+            return upload
+
+        await asyncio.to_thread(feed, None)
+        return upload
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error during database backup: {e}")
+        error = e
+    except Exception as e:
+        logger.error(f"Unexpected error during backup: {str(e)}")
+        error = e
+    except BaseException:
+        # On cancellation the upload still needs its stream ended, or its
+        # worker waits for the next chunk forever
+        abort(RuntimeError("database backup was cancelled"))
+        raise
+
+    abort(error)
+    return None
+
+def backup_database_parallel(dump_name, jobs, keep_local=False, compress="9", tables=None):
+    """Dump the database with parallel jobs and upload the dump directory."""
+    backup_dir = os.path.join(BACKUP_DIR, dump_name)
+
+    # Parallel dumps need the directory format, which cannot be written to a pipe
+    cmd = pg_cmd("pg_dump", "-Fd", "-j", str(jobs), "-Z", compress, "-f", backup_dir, *filter_options(tables))
+
+    proc = None
+    uploaded = False
+    try:
+        logger.info(f"Starting parallel database backup with {jobs} jobs")
+        proc = subprocess.Popen(cmd, env=PG_ENV)
+
+        uploaded = upload_directory(proc, backup_dir, dump_name)
+        if not uploaded:
+            return None
+
+        logger.info(f"Database backup successful: {SUPABASE_BUCKET}/{dump_name}")
+        return dump_name
     except subprocess.CalledProcessError as e:
         logger.error(f"Error during database backup: {e}")
         return None
     except Exception as e:
         logger.error(f"Unexpected error during backup: {str(e)}")
         return None
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if proc is not None and not uploaded:
+            # Don't leave a partial dump behind that could pass for a complete one
+            delete_remote_prefix(f"{dump_name}/")
+        if not keep_local:
+            shutil.rmtree(backup_dir, ignore_errors=True)
+
+def get_table_stats():
+    """Return the row change counters of every user table."""
+    query = (
+        "SELECT quote_ident(schemaname) || '.' || quote_ident(relname), "
+        "n_tup_ins + n_tup_upd + n_tup_del, n_live_tup "
+        "FROM pg_stat_user_tables"
+    )
+    cmd = pg_cmd("psql", "-X", "-A", "-t", "-F", "\t", "-c", query)
+    output = subprocess.run(cmd, env=PG_ENV, check=True, capture_output=True, text=True).stdout
+
+    stats = {}
+    for line in output.splitlines():
+        table, changes, live = line.rsplit("\t", 2)
+        stats[table] = [int(changes), int(live)]
+    return stats
+
+def plan_backup(full_every):
+    """Decide whether this run takes a full or a differential dump.
+
+    Returns the tables to dump (None for a full dump) and the state to save
+    once the backup is uploaded. Differential dumps cover every table whose
+    counters moved since the last full dump, so restoring needs only that
+    full dump and the latest differential one.
+    """
+    try:
+        stats = get_table_stats()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f"Error reading table statistics, taking a full dump: {e}")
+        return None, None
+
+    state = load_backup_state()
+    if state is None or state["runs_since_full"] + 1 >= full_every:
+        return None, {"runs_since_full": 0, "base": None, "stats": stats}
+
+    # Counters go backwards after a stats reset, and dropped tables cannot be
+    # expressed as -t filters, so both need a fresh full dump
+    base_stats = state["stats"]
+    if any(table not in stats or stats[table][0] < counters[0] for table, counters in base_stats.items()):
+        return None, {"runs_since_full": 0, "base": None, "stats": stats}
+
+    changed = [table for table, counters in stats.items() if base_stats.get(table) != counters]
+    return changed, {**state, "runs_since_full": state["runs_since_full"] + 1}
+
+def load_backup_state():
+    """Read the differential backup state saved by the last run, if any."""
+    try:
+        with open(STATS_FILE) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+def save_backup_state(state):
+    """Persist the differential backup state for the next run."""
+    with open(STATS_FILE, "w") as state_file:
+        json.dump(state, state_file)
 
-def upload_to_supabase(file_path):
-    """Upload the backup file to Supabase Storage."""
-    file_name = os.path.basename(file_path)
+def upload_manifest(dump_name, manifest):
+    """Upload the JSON manifest describing a backup next to it."""
+    file_name = f"{dump_name}.manifest.json"
+
+    try:
+        get_s3_client().put_object(
+            Bucket=SUPABASE_BUCKET,
+            Key=file_name,
+            Body=json.dumps(manifest, indent=2).encode(),
+            ContentType="application/json"
+        )
+        logger.info(f"Manifest uploaded successfully to: {SUPABASE_BUCKET}/{file_name}")
+        return True
+    except Exception as e:
+        logger.error(f"Error uploading manifest to Supabase: {e}")
+        return False
+
+def upload_to_supabase(file_path, file_name=None):
+    """Upload a backup file to Supabase Storage as a parallel multipart upload."""
+    file_name = file_name or os.path.basename(file_path)
 
     try:
         logger.info(f"Starting upload of file: {file_name}")
-        with open(file_path, "rb") as file_data:
-            response = supabase.storage.from_(SUPABASE_BUCKET).upload(file_name, file_data)
-            
+        get_s3_client().upload_file(file_path, SUPABASE_BUCKET, file_name, Config=transfer_config)
+
         logger.info(f"File uploaded successfully to: {SUPABASE_BUCKET}/{file_name}")
+        return True
+    except Exception as e:
+        logger.error(f"Error uploading to Supabase: {e}")
+        return False
+
+def upload_stream_to_supabase(file_data, file_name):
+    """Upload a backup stream to Supabase Storage as a multipart upload."""
+    try:
+        logger.info(f"Starting upload of file: {file_name}")
+        get_s3_client().upload_fileobj(file_data, SUPABASE_BUCKET, file_name, Config=transfer_config)
 
+        logger.info(f"File uploaded successfully to: {SUPABASE_BUCKET}/{file_name}")
+        return True
+    except UnchangedBackup:
+        raise
     except Exception as e:
         logger.error(f"Error uploading to Supabase: {e}")
-        if hasattr(e, 'message'):
-            logger.error(f"Error message: {e.message}")
+        return False
+
+def get_latest_digest():
+    """Return the SHA-256 and file name recorded for the latest streamed backup, if any."""
+    try:
+        response = get_s3_client().get_object(Bucket=SUPABASE_BUCKET, Key=LATEST_DIGEST_KEY)
+        latest_digest, latest_file_name = response["Body"].read().decode().split()
+        return latest_digest, latest_file_name
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            logger.error(f"Error reading latest backup digest from Supabase: {e}")
+    except Exception as e:
+        logger.error(f"Error reading latest backup digest from Supabase: {e}")
+    return None, None
+
+def put_latest_digest(digest, file_name):
+    """Record the SHA-256 of a freshly uploaded backup as the latest one."""
+    try:
+        get_s3_client().put_object(
+            Bucket=SUPABASE_BUCKET,
+            Key=LATEST_DIGEST_KEY,
+            Body=f"{digest}  {file_name}\n".encode(),
+            ContentType="text/plain"
+        )
+    except Exception as e:
+        logger.error(f"Error recording latest backup digest in Supabase: {e}")
+
+def scan_dump_directory(dir_path):
+    """Map each file in a dump directory to its (size, mtime) signature."""
+    signatures = {}
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                signatures[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return signatures
+
+def upload_directory(proc, dir_path, prefix, max_workers=8, poll_interval=1):
+    """Upload a directory-format dump to Supabase Storage while pg_dump writes it.
+
+    A table file is picked up once its size and mtime hold steady between two
+    polls. After pg_dump exits, any file that changed since it was picked up
+    is uploaded again. toc.dat, which makes the dump restorable, only goes up
+    once every table file has been uploaded. pg_dump is killed as soon as an
+    upload fails.
+    """
+    uploads = {}
+
+    def submit(executor, file_name, signature):
+        future = executor.submit(upload_to_supabase, os.path.join(dir_path, file_name), f"{prefix}/{file_name}")
+        uploads[file_name] = (signature, future)
+
+    def upload_failed():
+        return any(future.done() and not future.result() for _, future in uploads.values())
+
+    # The pool size caps how many files are uploading at once
+    completed = False
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            previous = {}
+            while proc.poll() is None:
+                time.sleep(poll_interval)
+                if upload_failed():
+                    proc.kill()
+                    proc.wait()
+                    logger.error("Stopping database backup after a failed upload")
+                    return False
+
+                current = scan_dump_directory(dir_path)
+                for file_name, signature in current.items():
+                    if file_name != "toc.dat" and file_name not in uploads and previous.get(file_name) == signature:
+                        submit(executor, file_name, signature)
+                previous = current
+
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+            files = scan_dump_directory(dir_path)
+            if "toc.dat" not in files:
+                logger.error(f"pg_dump did not write toc.dat to {dir_path}")
+                return False
+
+            for file_name, signature in files.items():
+                if file_name == "toc.dat":
+                    continue
+                if file_name in uploads:
+                    uploaded_signature, future = uploads[file_name]
+                    if uploaded_signature == signature:
+                        continue
+                    # Never let a stale copy finish after the fresh one
+                    future.result()
+                submit(executor, file_name, signature)
+
+            if not all(future.result() for _, future in uploads.values()):
+                return False
+            completed = True
+        finally:
+            if not completed:
+                # The partial dump is deleted, so don't start uploads still queued
+                executor.shutdown(cancel_futures=True)
+
+    return upload_to_supabase(os.path.join(dir_path, "toc.dat"), f"{prefix}/toc.dat")
+
+def remove_backup(entry):
+    """Delete a single local backup file or dump directory."""
+    try:
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+        logger.info(f"Deleted old backup: {entry.path}")
+    except OSError as e:
+        logger.error(f"Error deleting old backup {entry.path}: {e}")
 
 def cleanup_old_backups(days=7):
-    """Delete local backup files older than 'days' days."""
-    now = datetime.now()
-    for filename in os.listdir(BACKUP_DIR):
-        file_path = os.path.join(BACKUP_DIR, filename)
-        if os.path.isfile(file_path):
-            file_age = (now - datetime.fromtimestamp(os.path.getmtime(file_path))).days
-            if file_age > days:
-                os.remove(file_path)
-                logger.info(f"Deleted old backup: {file_path}")
+    """Delete local backups older than 'days' days.
 
-if __name__ == "__main__":
+    Only entries this script created are touched, since BACKUP_DIR may hold
+    anything else the user keeps there.
+    """
+    cutoff = time.time() - days * 86400
+    with os.scandir(BACKUP_DIR) as entries:
+        stale = [
+            entry for entry in entries
+            if entry.name.startswith("db_backup_")
+            and (entry.is_file(follow_symlinks=False) or entry.is_dir(follow_symlinks=False))
+            and entry.stat(follow_symlinks=False).st_mtime < cutoff
+        ]
+
+    # A thread pool only pays for itself once there are enough unlinks to overlap
+    if len(stale) > 16:
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            list(executor.map(remove_backup, stale))
+    else:
+        for entry in stale:
+            remove_backup(entry)
+
+def delete_remote_objects(keys):
+    """Delete keys from Supabase Storage in batches, returning how many went."""
+    s3 = get_s3_client()
+
+    # DeleteObjects takes at most 1000 keys per request
+    deleted = 0
+    for start in range(0, len(keys), 1000):
+        batch = keys[start:start + 1000]
+        response = s3.delete_objects(
+            Bucket=SUPABASE_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+        )
+        errors = response.get("Errors", [])
+        for error in errors:
+            logger.error(f"Error deleting {error['Key']} from Supabase: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+    return deleted
+
+def delete_remote_prefix(prefix):
+    """Delete every object under a prefix from Supabase Storage."""
+    try:
+        keys = [
+            obj["Key"]
+            for page in get_s3_client().get_paginator("list_objects_v2").paginate(Bucket=SUPABASE_BUCKET, Prefix=prefix)
+            for obj in page.get("Contents", [])
+        ]
+        if delete_remote_objects(keys):
+            logger.info(f"Deleted incomplete backup: {SUPABASE_BUCKET}/{prefix}")
+    except Exception as e:
+        logger.error(f"Error deleting incomplete backup {prefix} from Supabase: {e}")
+
+def cleanup_remote_backups(days, keep=()):
+    """Delete backups older than 'days' days from Supabase Storage in batches.
+
+    Backups are aged by the timestamp in their name. 'keep' names backups to
+    leave alone, such as the latest one and the full dump that newer
+    differentials build on.
+    """
+    cutoff = time.strftime("%Y%m%d_%H%M%S", time.localtime(time.time() - days * 86400))
+    s3 = get_s3_client()
+
+    try:
+        stale = []
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=SUPABASE_BUCKET, Prefix="db_backup_"):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                # db_backup_<timestamp>[_diff] followed by .dump, .manifest.json or /<file>
+                name = key.split("/", 1)[0].split(".", 1)[0]
+                if name not in keep and name[len("db_backup_"):] < cutoff:
+                    stale.append(key)
+
+        deleted = delete_remote_objects(stale)
+        if deleted:
+            logger.info(f"Deleted {deleted} old backup objects from: {SUPABASE_BUCKET}")
+    except Exception as e:
+        logger.error(f"Error cleaning up old backups in Supabase: {e}")
+
+def acquire_backup_lock():
+    """Take an exclusive lock on BACKUP_DIR, held until the process exits.
+
+    Returns the locked file descriptor, or None if another run holds the lock.
+    """
+    lock_fd = os.open(LOCK_FILE, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        return None
+    return lock_fd
+
+async def main(args):
     logger.info("Starting backup process")
-    backup_file = backup_database()
-    if backup_file:
-        upload_to_supabase(backup_file)
-        cleanup_old_backups(days=7)
-    logger.info("Backup process completed")
\ No newline at end of file
+    tables, state = plan_backup(args.full_every) if args.full_every else (None, None)
+
+    if tables == []:
+        logger.info("No tables changed since the last full backup, skipping dump")
+        save_backup_state(state)
+        logger.info("Backup process completed")
+        return
+
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    dump_name = f"db_backup_{timestamp}" if tables is None else f"db_backup_{timestamp}_diff"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if args.jobs > 1:
+            backup_name = await asyncio.to_thread(
+                backup_database_parallel,
+                dump_name, args.jobs, keep_local=args.keep_local, compress=args.compress, tables=tables
+            )
+            if backup_name:
+                await asyncio.to_thread(cleanup_old_backups, days=7)
+        else:
+            upload = await backup_database(
+                executor, dump_name, keep_local=args.keep_local, compress=args.compress, tables=tables
+            )
+            backup_name = None
+            if upload is not None:
+                # Cleanup only touches old backups, so it can run while the upload drains
+                cleanup = executor.submit(cleanup_old_backups, days=7)
+                backup_name = await asyncio.wrap_future(upload)
+                await asyncio.wrap_future(cleanup)
+
+    if backup_name and state is not None:
+        if tables is None:
+            state["base"] = backup_name
+        if backup_name != dump_name:
+            # An unchanged dump was not stored again, so the existing backup
+            # and its manifest stand in for it
+            save_backup_state(state)
+        else:
+            manifest = {
+                "type": "full" if tables is None else "differential",
+                "base": state["base"],
+                "tables": tables
+            }
+            if upload_manifest(dump_name, manifest):
+                save_backup_state(state)
+
+    if backup_name and args.prune_remote is not None:
+        # Protect this run's backup, which a small DAYS would otherwise age
+        # out, and the base the saved state points at, which is what the next
+        # differential builds on, even if this run could not update the state
+        keep = {backup_name}
+        saved_state = load_backup_state()
+        if saved_state and saved_state["base"]:
+            keep.add(saved_state["base"])
+        await asyncio.to_thread(cleanup_remote_backups, args.prune_remote, keep=keep)
+    logger.info("Backup process completed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Back up a Postgres database to Supabase Storage.")
+    parser.add_argument(
+        "--keep-local",
+        action="store_true",
+        help="also keep a copy of the dump in BACKUP_DIR"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="dump this many tables in parallel using pg_dump's directory format"
+    )
+    parser.add_argument(
+        "-Z", "--compress",
+        default="9",
+        help="pg_dump compression level or method, e.g. 6 or zstd:3 (default: 9)"
+    )
+    parser.add_argument(
+        "--full-every",
+        type=int,
+        metavar="N",
+        help="take a full dump every N runs and differential dumps of the tables "
+             "with row changes in between (schema-only changes wait for the next full dump)"
+    )
+    parser.add_argument(
+        "--prune-remote",
+        type=int,
+        metavar="DAYS",
+        help="after a successful backup, delete backups older than DAYS days from the bucket"
+    )
+    args = parser.parse_args()
+
+    lock_fd = acquire_backup_lock()
+    if lock_fd is None:
+        logger.warning("Another backup is already in progress, exiting")
+        sys.exit(0)
+    asyncio.run(main(args))